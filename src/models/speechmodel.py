@@ -1,5 +1,6 @@
 import numpy as np
 import matplotlib.pyplot as plt
+from numba import njit
 
 
 class InputLayer():
@@ -9,13 +10,17 @@ class InputLayer():
     # TODO Implement conversion of MFSC spectograms to spikes
     def __call__(self, mfsc_input, n_time_options):
         """ Compute time-to-first-spike array from MFSC spectrogram and return
-        it as list of 2-D binary spike matrices for discrete timesteps
+        it as list of 2-D binary spike matrices for discrete timesteps. The
+        input is converted to float64 first, like in `batch`, so both assign
+        values on the boundary of two ranges to the same timestep.
         """
 
         # Check shape of inputs
         if mfsc_input.shape != self.input_shape:
             raise ValueError()
 
+        mfsc_input = np.asarray(mfsc_input, dtype=np.float64)
+
         minimum = np.amin(mfsc_input)
         maximum = np.amax(mfsc_input) +1 #+1 such that max value also fits.
         width = (maximum - minimum)/n_time_options
@@ -28,7 +33,35 @@ class InputLayer():
                 value = n_time_options-value-1
                 converted[value,ind1,ind2] = 1
         return converted
-        
+
+    def batch(self, mfsc_inputs, n_time_options):
+        """ Compute time-to-first-spike arrays for a batch of MFSC spectrograms
+        at once. Returns an array of shape (batch, n_time_options, *input_shape)
+        holding the binary spike matrices of every sample. The inputs are
+        converted to float64 first, since the ranges are computed by division
+        here instead of by stepping through them as in `__call__`, which only
+        gives the same ranges in double precision.
+        """
+
+        # Check shape of inputs
+        if mfsc_inputs.shape[1:] != self.input_shape:
+            raise ValueError()
+
+        mfsc_inputs = np.asarray(mfsc_inputs, dtype=np.float64)
+
+        minimum = np.amin(mfsc_inputs, axis=(1,2), keepdims=True)
+        maximum = np.amax(mfsc_inputs, axis=(1,2), keepdims=True) +1 #+1 such that max value also fits.
+        width = (maximum - minimum)/n_time_options
+        # Index of the range every value falls into, for all samples at once
+        values = np.floor((mfsc_inputs - minimum) / width).astype(int)
+        values = np.clip(values, 0, n_time_options-1)
+        # revert to let the neuron fire earlier with higher feature values
+        values = n_time_options-values-1
+        converted = np.zeros((mfsc_inputs.shape[0], n_time_options) + self.input_shape)
+        samples, rows, cols = np.indices(mfsc_inputs.shape)
+        converted[samples, values, rows, cols] = 1
+        return converted
+
     def dummy_call(self, n_timesteps):
         """ Return list of `n_timesteps` of `self.shape` sized matrices that
         contain random spikes for neurons """
@@ -46,6 +79,73 @@ class InputLayer():
             if ranges[i][0] <= value < ranges[i][1]:
                 return i
 
+@njit(cache=True, nogil=True)
+def conv_step(weights, spikes, membrane_voltages, input_spike_history,
+              allowed_to_spike, allowed_to_learn, output_spikes, window_size,
+              sharing_size, v_thresh, v_reset, A_plus, A_minus, is_training):
+    """ Compiled kernel for a single timestep of the convolutional layer.
+    Updates membrane potentials, records spikes into `output_spikes`, applies
+    STDP and lateral inhibition in place, exactly like the original per-neuron
+    loop in `ConvLayer.__call__`. Rows and feature maps cannot be processed in
+    parallel, as inhibition and STDP depend on the order of the neurons. The
+    GIL is released, so separate layers can run this from different threads.
+
+    Returns
+    -------
+    delta_weight: total absolute weight change in this timestep
+    """
+
+    n_rows, n_cols = membrane_voltages.shape
+    n_inputs = spikes.shape[1]
+    delta_weight = 0.0
+
+    for row in range(n_rows):
+        window = row // sharing_size
+        for col in range(n_cols):
+
+            # Update membrane potential if not inhibited
+            potential = 0.0
+            for i in range(window_size):
+                for j in range(n_inputs):
+                    potential += weights[window, col, i, j] * spikes[row + i, j]
+            membrane_voltages[row, col] += allowed_to_spike[row, col] * potential
+
+            # Post-synaptic spike
+            if membrane_voltages[row, col] >= v_thresh:
+                # Record spike
+                output_spikes[row, col] = True
+                # Reset membrane potential
+                membrane_voltages[row, col] = v_reset
+
+                # Update weights if stpd is allowed for this neuron
+                if is_training:
+                    learn = allowed_to_learn[row, col]
+                    for i in range(window_size):
+                        for j in range(n_inputs):
+                            weight = weights[window, col, i, j]
+                            part_used = weight * (1 - weight)
+                            history = input_spike_history[row + i, j]
+                            # Update for input spike before output spike
+                            # and for elsewise
+                            delta = learn * A_plus * part_used * history \
+                                + learn * -A_minus * part_used * abs(history - 1)
+                            weights[window, col, i, j] += delta
+                            # Keep track of the total weight change
+                            delta_weight += abs(delta)
+
+                # Lateral inhibition of neurons in this row
+                allowed_to_spike[row, :] = 0
+                # Disallowing row of neurons to learn with STDP
+                allowed_to_learn[row, :] = 0
+                # Disallowing neighborhood neurons to learn with STDP
+                lower = row - row % window_size
+                upper = min(row + window_size - row % window_size, n_rows)
+                allowed_to_learn[lower:upper, col] = 0
+                # Break for fast inhibition (no unneeded checks done)
+                break
+
+    return delta_weight
+
 class ConvLayer():
     def __init__(self,
                  input_shape,
@@ -151,55 +251,60 @@ class ConvLayer():
 
         output_spikes = np.zeros(self.output_shape, dtype=bool)
 
-        # Record spikes and update weights
-        for row in range(self.output_shape[0]):
-            for col in range(self.output_shape[1]):
-
-                # Update membrane potential if not inhibited
-                self.membrane_voltages[row, col] += self.allowed_to_spike[row, col] * np.sum(np.multiply(
-                    self.weights[row // self.sharing_size, col, :, :],
-                    spikes[row:row + self.window_size, :]))
-
-                # Post-synaptic spike
-                if self.membrane_voltages[row, col] >= self.v_thresh:
-                    # Record spike
-                    output_spikes[row, col] = True
-                    # Reset membrane potential
-                    self.membrane_voltages[row, col] = self.v_reset
-
-                    # Update weights if stpd is allowed for this neuron
-                    if self.is_training:
-                        #First, compute in advance to reduce number of computations
-                        part_used = np.multiply(self.weights[row // self.sharing_size, col, :, :],
-                                                                (1 - self.weights[row // self.sharing_size, col, :, :]))
-                        # Update for input spike before output spike
-                        delta_weights = self.allowed_to_learn[row, col] * self.A_plus * \
-                                        np.multiply(part_used,
-                                                    self.input_spike_history[row:row + self.window_size, :])
-                        #self.weights[row // self.sharing_size, col, :, :] += delta_weights
-                        # Keep track of the total weight change
-                        #self.delta_weight += np.sum(abs(delta_weights))
-
-                        # Update for elsewise
-                        delta_weights += self.allowed_to_learn[row, col] * -self.A_minus * \
-                                        np.multiply(part_used,
-                                                    abs(self.input_spike_history[row:row + self.window_size, :] - 1))
-                        self.weights[row // self.sharing_size, col, :, :] += delta_weights
-                        # Keep track of the total weight change
-                        self.delta_weight += np.sum(abs(delta_weights))
-
-                    # Lateral inhibition of neurons in this row
-                    self.allowed_to_spike[row, :] = 0
-                    # Disallowing row of neurons to learn with STDP
-                    self.allowed_to_learn[row, :] = 0
-                    # Disallowing neighborhood neurons to learn with STDP
-                    self.allowed_to_learn[row - row % self.window_size: row + self.window_size - row % self.window_size,
-                                          col] = 0
-                    # Break for fast inhibition (no unneeded checks done)
-                    break
+        # Record spikes and update weights in the compiled kernel
+        self.delta_weight += conv_step(
+            self.weights, spikes, self.membrane_voltages,
+            self.input_spike_history, self.allowed_to_spike,
+            self.allowed_to_learn, output_spikes, self.window_size,
+            self.sharing_size, self.v_thresh, self.v_reset, self.A_plus,
+            self.A_minus, self.is_training)
 
         return output_spikes
 
+    def batch(self, spike_frames):
+        """ Run the layer with frozen weights on the spike frames of a whole
+        batch at once. Without STDP, every row of neurons spikes at most once
+        per sample: the first neuron to reach the threshold inhibits the rest
+        of its row. Until then the membrane potentials only integrate their
+        input, so all samples and timesteps can be computed together. Does
+        not change the internal state of the layer.
+
+        Parameters
+        ----------
+        spike_frames: 4-D binary Numpy array of shape
+            (batch, timesteps, *input_shape) with the input spikes
+
+        Returns
+        -------
+        spike_counts: 3-D Numpy array of shape (batch, *output_shape) with the
+            number of spikes of every neuron, summed over all timesteps
+        """
+
+        n_samples, n_timesteps = spike_frames.shape[:2]
+
+        # Input to every neuron at every timestep, computed per row since
+        # the weights are shared between neighbouring rows only
+        inputs = np.empty((n_samples, n_timesteps) + self.output_shape)
+        for row in range(self.output_shape[0]):
+            inputs[:, :, row, :] = np.tensordot(
+                spike_frames[:, :, row:row + self.window_size, :],
+                self.weights[row // self.sharing_size],
+                axes=([2, 3], [1, 2]))
+
+        # Membrane potentials before the first spike of a row
+        crossed = np.cumsum(inputs, axis=1) >= self.v_thresh
+
+        # Find the first timestep at which a row spikes, and the first
+        # feature map in that row that crosses the threshold at that time
+        crossed_rows = crossed.any(axis=3)
+        samples, rows = np.nonzero(crossed_rows.any(axis=1))
+        timesteps = crossed_rows.argmax(axis=1)[samples, rows]
+        cols = crossed[samples, timesteps, rows, :].argmax(axis=1)
+
+        spike_counts = np.zeros((n_samples,) + self.output_shape)
+        spike_counts[samples, rows, cols] = 1
+        return spike_counts
+
     def reset(self):
         """ Reset all internal states for a new input sample. """
         self.membrane_voltages = np.zeros(self.output_shape)
@@ -259,6 +364,24 @@ class PoolingLayer():
         """ Reset all internal states for a new input sample. """
         self.membrane_voltages = np.zeros(self.output_shape)
 
+    def batch(self, spike_counts):
+        """ Pool the spike counts of the convolutional layer, already summed
+        over timesteps, for a whole batch at once. Does not change the
+        internal state of the layer.
+
+        Parameters
+        ----------
+        spike_counts: 3-D Numpy array of shape (batch, *input_shape)
+
+        Returns
+        -------
+        membrane_voltages: 3-D Numpy array of shape (batch, *output_shape)
+        """
+        n_pooled = self.output_shape[0] * self.pooling_size
+        return spike_counts[:, :n_pooled].reshape(
+            spike_counts.shape[0], self.output_shape[0], self.pooling_size,
+            self.output_shape[1]).sum(axis=2)
+
     def print_pooling(self, potentials, label):
         """" Plot the pooling potentials/SNN output for a specific digit label"""
         plt.imshow(potentials)
@@ -282,6 +405,9 @@ class SpeechModel():
         self.pooling_layer = PoolingLayer(self.conv_layer.output_shape)
         # Set the amount of timesteps to unfold the input to
         self.n_time_options = n_time_options
+        # Smallest total weight change of a sample in the last call, used as
+        # stopping criterion
+        self.min_delta_weight = 0
         
     def load_weights(self, path):
         """ Load weights for the model from a numpy array stored on disk.
@@ -305,7 +431,9 @@ class SpeechModel():
         self.conv_layer.is_training = True
 
     def check_stopping_criterion(self):
-        return self.conv_layer.delta_weight < 0.01
+        """ Whether the weights changed insufficiently for any sample in the
+        last call or batch. """
+        return self.min_delta_weight < 0.01
         
     def __call__(self, input_mfsc):
         """ Run the SpeechModel on a single MFSC spectrogram frame. Returns a 
@@ -314,14 +442,59 @@ class SpeechModel():
         image depends on whether the weights are frozen or not.
         """
 
-        # Reset layers
-        self.conv_layer.reset()
-        self.pooling_layer.reset()
-        
         # Get the spike representations from the input layer
         spike_frames = self.input_layer(
             input_mfsc, n_time_options=self.n_time_options)
-        
+
+        pooling_potentials = self.run_spikes(spike_frames)
+        self.min_delta_weight = self.conv_layer.delta_weight
+
+        return pooling_potentials
+
+    def batch(self, input_mfscs, on_sample=None):
+        """ Run the SpeechModel on a batch of MFSC spectrograms. The spike
+        conversion is done for the whole batch at once. If the weights are
+        frozen, so is the rest of the network; otherwise the samples are fed
+        through the convolutional layer one after another, since STDP learning
+        depends on the weights left by the previous sample. Returns an array
+        with the pooling potentials of every sample in the batch.
+
+        If the model is learning and `on_sample` is given, it is called with
+        the index of every sample in the batch right after the model ran on
+        it, e.g. to record the weights at an exact training step.
+        """
+
+        # Get the spike representations of all samples from the input layer
+        spike_frames = self.input_layer.batch(
+            input_mfscs, n_time_options=self.n_time_options)
+
+        if not self.conv_layer.is_training:
+            # Frozen weights do not change
+            self.min_delta_weight = 0
+            return self.pooling_layer.batch(self.conv_layer.batch(spike_frames))
+
+        potentials = np.empty(
+            (input_mfscs.shape[0],) + self.pooling_layer.output_shape)
+        # The weight change is reset for every sample, so keep track of the
+        # smallest one in this batch for the stopping criterion
+        self.min_delta_weight = np.inf
+        for i in range(input_mfscs.shape[0]):
+            potentials[i] = self.run_spikes(spike_frames[i])
+            self.min_delta_weight = min(
+                self.min_delta_weight, self.conv_layer.delta_weight)
+            if on_sample is not None:
+                on_sample(i)
+
+        return potentials
+
+    def run_spikes(self, spike_frames):
+        """ Feed the spike frames of a single sample through the convolutional
+        and pooling layer and return the pooling potentials. """
+
+        # Reset layers
+        self.conv_layer.reset()
+        self.pooling_layer.reset()
+
         # Iterate through matrices of binary spikes
         conv_spikes = []
         for spikes in spike_frames:
@@ -360,3 +533,51 @@ class SpeechModel():
         time = timeit.timeit(run, number=n_trials)
 
         print('Total time: {:.3f}s, Average: {:.3f}s'.format(time, time / n_trials))
+
+    def batch_test(self, n_samples):
+        """ Check that the batched code paths give the same results as running
+        the model on one sample at a time, using random inputs. The frozen
+        batch path relies on every row of the convolutional layer spiking at
+        most once per sample, so this should be run after changing the
+        convolutional layer. The model itself is not changed. Returns whether
+        all checks passed. """
+
+        import copy
+
+        print('Comparing batched and per-sample runs on {} random samples'
+            .format(n_samples))
+
+        inputs = np.random.normal(size=(n_samples,) + self.input_layer.input_shape)
+        checks = dict()
+
+        # Spike encoding of the input layer, also for single precision inputs
+        for dtype in [np.float64, np.float32]:
+            typed_inputs = inputs.astype(dtype)
+            single = np.stack([self.input_layer(x, self.n_time_options)
+                               for x in typed_inputs])
+            batched = self.input_layer.batch(typed_inputs, self.n_time_options)
+            checks['Input layer ({})'.format(np.dtype(dtype).name)] = \
+                np.array_equal(single, batched)
+
+        # Frozen model, which uses the vectorized convolutional layer
+        model = copy.deepcopy(self)
+        model.freeze()
+        single = np.stack([model(x) for x in inputs])
+        batched = model.batch(inputs)
+        checks['Frozen model'] = np.array_equal(single, batched)
+
+        # Learning model, where weights have to end up the same as well
+        single_model = copy.deepcopy(self)
+        batch_model = copy.deepcopy(self)
+        single_model.unfreeze()
+        batch_model.unfreeze()
+        single = np.stack([single_model(x) for x in inputs])
+        batched = batch_model.batch(inputs)
+        checks['Learning model'] = np.array_equal(single, batched) and \
+            np.array_equal(single_model.conv_layer.weights,
+                           batch_model.conv_layer.weights)
+
+        for name, passed in checks.items():
+            print('{}: {}'.format(name, 'OK' if passed else 'MISMATCH'))
+
+        return all(checks.values())
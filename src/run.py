@@ -1,5 +1,6 @@
 import argparse
 
+import matplotlib
 import numpy as np
 import pickle
 import timeit
@@ -29,6 +30,10 @@ def getArgs():
     parser.add_argument("--dummy_test", 
                         action='store_true',
                         help='Dummy test network and record time.')
+    parser.add_argument("--batch_test", 
+                        action='store_true',
+                        help='Check that batched runs of the network match '
+                        'runs on single samples.')
     parser.add_argument("--freeze",
                         action='store_true',
                         help='Freeze model parameters (i.e. no STDP).')
@@ -77,6 +82,16 @@ def getArgs():
                         help="Plot the output of the SNN (pooling potentials) "
                         "for a sample of each digit, given a trained model "
                         "using the --load flag.")
+    parser.add_argument("--plot_dir",
+                        type=str,
+                        help="Save the plots made after training to this "
+                        "directory instead of showing them, e.g. for headless "
+                        "runs.")
+    parser.add_argument("--cache_dir",
+                        type=str,
+                        help="Cache the shuffled and split train and test "
+                        "data in this directory, so later runs can skip "
+                        "preparing them. Off if not provided.")
     parser.add_argument("-v", "--verbose", 
                         dest='verbose', 
                         action='store_true', 
@@ -88,6 +103,10 @@ if __name__=='__main__':
 
     CONFIGS = getArgs()
 
+    # Render plots without a display if they are saved to disk
+    if CONFIGS.plot_dir:
+        matplotlib.use('Agg')
+
     model = SpeechModel(input_shape = (41,40), n_time_options=30)
 
     weights_path = 'models/weights/'
@@ -114,11 +133,13 @@ if __name__=='__main__':
                   ' labelpath: {}'.format(datapath, labelpath))
 
         # Create trainer for this data
-        trainer = Trainer(datapath, labelpath, validation_split=0.2)
+        trainer = Trainer(datapath, labelpath, validation_split=0.2,
+                          cache_dir=CONFIGS.cache_dir)
         
         # Fit the model on the data
         model, train_potentials, val_potentials, train_scores, val_scores, \
-            activations, freq = trainer.fit(model, epochs=CONFIGS.train)
+            activations, freq = trainer.fit(model, epochs=CONFIGS.train,
+                                            plot_dir=CONFIGS.plot_dir)
 
     if CONFIGS.save:
 
@@ -138,7 +159,7 @@ if __name__=='__main__':
         # Save training scores as a dictionary
         history = dict()
         history['train_acc'] = train_scores
-        if val_scores:
+        if val_scores is not None:
             history['val_acc'] = val_scores
         history_filename = 'models/logs/train_history_{}.npy'.format(CONFIGS.save)
         with open(history_filename, 'wb') as f:
@@ -221,6 +242,10 @@ if __name__=='__main__':
         # Freeze model
         model.freeze()
 
+    if CONFIGS.batch_test:
+        # Test batched code paths
+        model.batch_test(n_samples=8)
+
     if CONFIGS.dummy_test:
         # Test speed
         model.time_test(n_trials=1, n_timesteps=20)
@@ -260,6 +285,7 @@ if __name__=='__main__':
         _,train_labels,_,_ = load_data_from_path(train_path, train_labelpath, 0.2)
 
         # Run testing
-        tester = Tester(test_datapath, test_labelpath)
+        tester = Tester(test_datapath, test_labelpath,
+                        cache_dir=CONFIGS.cache_dir)
         tester.evaluate(model, train_potentials, train_labels)
 
@@ -1,7 +1,9 @@
+import hashlib
+import os
+
 import numpy as np
 import pandas as pd
 from scipy.io import loadmat
-from sklearn.utils import shuffle as sklearn_shuffle
 
 from ..data.mfsc import result_handler
 
@@ -9,58 +11,157 @@ def load_data_from_path(datapath:str,
                         labelpath:str,
                         validation_split:float=0.0,
                         shuffle:bool=True,
-                        random_seed=123):
+                        random_seed=123,
+                        cache_dir:str=None):
+
+        # If a cache directory is provided, shuffled, split and transposed
+        # data are stored there on the first run, and memory-mapped from there
+        # on later runs
+        if cache_dir is not None:
+            cache_paths = get_cache_paths(cache_dir, datapath, labelpath,
+                validation_split, shuffle, random_seed)
+            splits = load_cache(cache_paths)
+            if splits is not None:
+                print("Read {} datapoints from cache with shape {}x{}"
+                    .format(sum(split.shape[0] for split in splits[::2]),
+                            splits[0].shape[1], splits[0].shape[2]))
+                if validation_split > 0.0:
+                    return tuple(splits)
+                else:
+                    return splits[0], splits[1], None, None
         
-        data = result_handler().load_file(datapath)
+        # Memory-map the data, so that no shuffled copy of the full dataset is
+        # made. The train and validation sets are still read into memory
+        data = result_handler().load_file(datapath, mmap_mode='r')
         labels = load_labels_from_mat(labelpath)
-        
-        if shuffle:
-            data, labels = sklearn_shuffle(data, labels, 
-                random_state=random_seed)
 
         assert data.shape[0] == labels.shape[0], \
             "Data and labels do not fit in shape"
 
+        # Get size of data and compute size of validation and training set 
+        # from provided validation split
+        datasize = data.shape[0]
+
+        # Shuffle only the indices into the data instead of the data itself.
+        # The same permutation also randomly splits off the validation set
+        if shuffle or validation_split > 0.0:
+            order = np.random.default_rng(random_seed).permutation(datasize)
+        else:
+            order = np.arange(datasize)
+
         # TODO This is only a temporary hard coded fix, because the data are
         # currently provided in a transposed manner. Hence, we need to trans-
-        # pose them back
-        if 'own' in datapath:
-            new_data = np.empty((data.shape[0], data.shape[2], data.shape[1]))
-            for i in range(data.shape[0]):
-                new_data[i] = data[i].T
-            data = new_data
+        # pose them back. A contiguous copy is cheaper than a strided view,
+        # which would slow down the spike encoding in every epoch
+        transpose = 'own' in datapath
 
         # Get data shape
-        datashape = (data.shape[1], data.shape[2])
+        if transpose:
+            datashape = (data.shape[2], data.shape[1])
+        else:
+            datashape = (data.shape[1], data.shape[2])
         print("Read {} datapoints from storage with shape {}x{}"
-            .format(data.shape[0], data.shape[1], data.shape[2]))
-
-        # Get size of data and compute size of validation and training set 
-        # from provided validation split
-        datasize = data.shape[0]
+            .format(datasize, datashape[0], datashape[1]))
 
         if validation_split > 0.0:
             valsize = int(datasize * validation_split)
             trainsize = datasize - valsize
 
-            # Randomly choose indices for validation and training set 
-            # corresponding to previously defined sizes
-            np.random.seed(random_seed)
-            val_indices = np.random.choice(
-                data.shape[0], valsize, replace=False)
-            train_indices = np.delete(np.arange(datasize), val_indices)
-        
-            # Get the data and labels
+            val_indices = order[:valsize]
+            train_indices = order[valsize:]
+            # Without shuffling, keep both sets in the order of the file
+            if not shuffle:
+                val_indices = np.sort(val_indices)
+                train_indices = np.sort(train_indices)
+
+            # Get the data and labels corresponding to previously defined
+            # sizes, reading each sample once from storage
             valdata = data[val_indices]
             traindata = data[train_indices]
             vallabels = labels[val_indices]
             trainlabels = labels[train_indices]
 
-            return traindata, trainlabels, valdata, vallabels
+            if transpose:
+                valdata = np.ascontiguousarray(valdata.transpose(0, 2, 1))
+                traindata = np.ascontiguousarray(traindata.transpose(0, 2, 1))
+
+            splits = (traindata, trainlabels, valdata, vallabels)
         
+        else:
+            data = data[order]
+            labels = labels[order]
+            if transpose:
+                data = np.ascontiguousarray(data.transpose(0, 2, 1))
+
+            splits = (data, labels)
+
+        if cache_dir is not None:
+            save_cache(cache_paths, splits)
+
+        if validation_split > 0.0:
+            return splits
         else:
             return data, labels, None, None
 
+def get_cache_paths(cache_dir:str,
+                    datapath:str, 
+                    labelpath:str,
+                    validation_split:float,
+                    shuffle:bool,
+                    random_seed):
+    """ Return the paths inside `cache_dir` of the cached train data, train 
+    labels and, if a validation split is used, validation data and labels for
+    the provided arguments of `load_data_from_path`. The paths contain a hash
+    of these arguments and of the modification times of both files, so that a
+    cache is not used anymore once the data or labels change. """
+
+    key = repr((os.path.abspath(datapath), os.path.abspath(labelpath), 
+                os.path.getmtime(datapath), os.path.getmtime(labelpath),
+                validation_split, shuffle, random_seed))
+    prefix = os.path.join(cache_dir, '{}_cache_{}'.format(
+        os.path.splitext(os.path.basename(datapath))[0],
+        hashlib.md5(key.encode()).hexdigest()[:10]))
+
+    names = ['traindata', 'trainlabels']
+    if validation_split > 0.0:
+        names += ['valdata', 'vallabels']
+    return ['{}_{}.npy'.format(prefix, name) for name in names]
+
+def load_cache(cache_paths):
+    """ Memory-map all cached arrays under `cache_paths`. Returns None if any
+    of them is missing or cannot be read. """
+
+    if not all(os.path.exists(path) for path in cache_paths):
+        return None
+    try:
+        return [np.load(path, mmap_mode='r') for path in cache_paths]
+    except (OSError, ValueError, EOFError):
+        print("[!] Warning: could not read cached data, reading from storage")
+        return None
+
+def save_cache(cache_paths, splits):
+    """ Save the arrays in `splits` under `cache_paths`. Every file is written
+    to a temporary path first and then moved into place, so an interrupted
+    write never leaves a truncated file under a cache path. The train labels
+    are written last. If the cache cannot be written, the data are still
+    used, only without caching. """
+
+    # Write train labels last
+    order = [i for i in range(len(splits)) if i != 1] + [1]
+    try:
+        os.makedirs(os.path.dirname(cache_paths[0]), exist_ok=True)
+        for i in order:
+            tmp_path = cache_paths[i] + '.tmp'
+            try:
+                with open(tmp_path, 'wb') as f:
+                    np.save(f, splits[i])
+                os.replace(tmp_path, cache_paths[i])
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+    except OSError as e:
+        print("[!] Warning: could not write data cache: {}".format(e))
+
 def load_labels_from_mat(path, typ:str='train'):
     """ Load class labels from a matlab file provided under `path` and return
     them as 1-D Numpy array of integers corresponding to the digit spoken.
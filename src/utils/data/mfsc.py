@@ -273,13 +273,14 @@ class result_handler():
         """
         np.save(filename, data)
 
-    def load_file(self, filename):
+    def load_file(self, filename, mmap_mode=None):
         """
         Loads data from a file
         :param filename: filename from which to load data
+        :param mmap_mode: if given, memory-map the file with this mode
         :return: loaded data
         """
-        data = np.load(filename)
+        data = np.load(filename, mmap_mode=mmap_mode)
         return data
 
     def print_mfsc(self, results, mat, sample_name, index):
@@ -1,6 +1,8 @@
+import os
 import sys
 
 import numpy as np 
+import matplotlib.pyplot as plt
 
 def prints(content, status):
     if status is 0:
@@ -13,6 +15,16 @@ def prints(content, status):
         msg = 'FAIL'
     print(f'\n[{msg}]\t{content}\n')
 
+def show_or_save(fig, plot_dir, filename):
+    """ Show a figure, or save it as `filename` inside `plot_dir` and close it
+    if a directory is provided, so that no window blocks the script. """
+    if plot_dir is None:
+        plt.show()
+    else:
+        os.makedirs(plot_dir, exist_ok=True)
+        fig.savefig(os.path.join(plot_dir, filename), dpi=100)
+        plt.close(fig)
+
 class ProgressNotifier():
 
     def __init__(self, total:int, title=''):
@@ -23,17 +35,19 @@ class ProgressNotifier():
     def reset(self):
         self.index = 1
 
-    def update(self):
+    def update(self, steps:int=1):
 
-        fraction = float(self.index) / self.total
+        # Advance by `steps` items at once, e.g. for a whole batch
+        current = min(self.index + steps - 1, self.total)
+        fraction = float(current) / self.total
         output = self.title
         numdigits = int(np.log10(self.total)) + 1
-        output += ('%' + str(numdigits) + 'd/%d') % (self.index, self.total)
+        output += ('%' + str(numdigits) + 'd/%d') % (current, self.total)
 
         # Add fraction as percentage
         output += (' - {}%'.format(int(fraction*100)))
 
-        self.index += 1
+        self.index += steps
         
         sys.stdout.write('\b' * 200)
         sys.stdout.write('\r')
@@ -61,19 +75,38 @@ class DataStream():
         and notify that index has to be reset. """
 
         # Fail safe if index has reached end of dataset
-        try:
-            # Draw the current image
-            item = self.data[self.index]
-        except IndexError:
+        if self.index >= self.size:
             raise IndexError(
                 "{} reached the end of its data. To use further, "
-                "call `reset()` to reset the index to 0.".format(name))
+                "call `reset()` to reset the index to 0.".format(self.name))
+
+        # Draw the current image
+        item = self.data[self.index]
 
         # Increase the index
         self.index += 1
 
         return item
 
+    def next_batch(self, batch_size):
+        """ Get up to `batch_size` datapoints starting at the current index and
+        increase the index accordingly. The last batch of the dataset may be
+        smaller. If the index has reached the end of the dataset, raise an
+        IndexError and notify that index has to be reset. """
+
+        if self.index >= self.size:
+            raise IndexError(
+                "{} reached the end of its data. To use further, "
+                "call `reset()` to reset the index to 0.".format(self.name))
+
+        # Slice the batch directly from the data
+        batch = self.data[self.index:self.index + batch_size]
+
+        # Increase the index
+        self.index += batch.shape[0]
+
+        return batch
+
     def reset(self):
         self.index = 0
 
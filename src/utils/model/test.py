@@ -3,8 +3,7 @@ import time
 
 import numpy as np
 from sklearn import svm
-from sklearn.utils import shuffle
-from sklearn.metrics import plot_confusion_matrix
+from sklearn.metrics import ConfusionMatrixDisplay, confusion_matrix
 import matplotlib.pyplot as plt
 
 from ..data.io import load_labels_from_mat, load_data_from_path
@@ -13,11 +12,13 @@ from ..generic import ProgressNotifier, DataStream
 
 class Tester():
 
-    def __init__(self, datapath, labelpath):
+    def __init__(self, datapath, labelpath, cache_dir=None):
         """ Load test data from provided paths and create a DataStream for this
-        data to use in `self.evaluate()` """
+        data to use in `self.evaluate()`. If `cache_dir` is given, the prepared
+        data are cached there. """
 
-        data, labels, _, _ = load_data_from_path(datapath, labelpath)
+        data, labels, _, _ = load_data_from_path(
+            datapath, labelpath, cache_dir=cache_dir)
 
         self.datashape = data.shape[1], data.shape[2]
 
@@ -25,7 +26,10 @@ class Tester():
         self.prog = ProgressNotifier(
             title='Collecting Test Potentials', total=self.stream.size)
 
-    def evaluate(self, model, train_potentials, train_labels):
+    def evaluate(self, model, train_potentials, train_labels, batch_size=32):
+        """ Collect the potentials of the frozen model on the test data,
+        `batch_size` images at a time, and score a LinearSVC fitted on the
+        training potentials on them. """
 
         if self.datashape != model.input_layer.input_shape:
             raise ValueError(
@@ -41,15 +45,19 @@ class Tester():
             model.freeze()
             print("WARNING: model weights were automatically frozen")
 
-        potentials = np.empty((
-            self.stream.size, 
-            model.pooling_layer.output_shape[0], 
-            model.pooling_layer.output_shape[1]))
+        # Store the potentials flattened, so they can be passed to the
+        # classifier without reshaping, and as float32 spike counts
+        n_features = model.pooling_layer.output_shape[0] \
+            * model.pooling_layer.output_shape[1]
+        potentials = np.empty((self.stream.size, n_features), dtype=np.float32)
         
-        # TEST on the testing data
-        for i in range(self.stream.size):
-            potentials[i] = model(self.stream.next())                    
-            self.prog.update()
+        # TEST on the testing data, one batch at a time
+        for start in range(0, self.stream.size, batch_size):
+            batch = self.stream.next_batch(batch_size)
+            end = start + batch.shape[0]
+            potentials[start:end] = \
+                model.batch(batch).reshape(batch.shape[0], n_features)
+            self.prog.update(batch.shape[0])
         print()
 
         # Reset stream and prog notifier
@@ -57,25 +65,25 @@ class Tester():
         self.prog.reset()
         
         # Fit classifier on the potentials
+        # Training potentials may be stored unflattened, so reshape them once
+        train_potentials = train_potentials.reshape(
+            train_potentials.shape[0], n_features)
         clf = svm.LinearSVC(max_iter=5000)
         print('Fitting LinearSVC on training potentials')
-        clf = clf.fit(
-            train_potentials.reshape(train_potentials.shape[0],9*50), 
-            train_labels)
-        train_score = clf.score(
-            train_potentials.reshape(train_potentials.shape[0],9*50),
-            train_labels)
-        test_score = clf.score(
-            potentials.reshape(self.stream.size,9*50), 
-            self.stream.labels)
+        clf = clf.fit(train_potentials, train_labels)
+        train_score = clf.score(train_potentials, train_labels)
+        # Predict the test set once and use it for both the score and the
+        # confusion matrix
+        predictions = clf.predict(potentials)
+        test_score = np.mean(predictions == self.stream.labels)
             
         print('Training Accuracy: {:.2f}'.format(train_score))
         print('Testing Accuracy: {:.2f}'.format(test_score))
 
-        plot_confusion_matrix(clf, potentials.reshape(self.stream.size, 9*50),
-                              self.stream.labels,
-                              labels=list(map(int, list(set(self.stream.labels)))),
-                              values_format='d')
+        labels = list(map(int, list(set(self.stream.labels))))
+        ConfusionMatrixDisplay(
+            confusion_matrix(self.stream.labels, predictions, labels=labels),
+            display_labels=labels).plot(values_format='d')
         plt.show()
 
         return potentials
@@ -3,12 +3,11 @@ import time
 
 import numpy as np
 from sklearn import svm
-from sklearn.utils import shuffle
+from joblib import Parallel, delayed, cpu_count
 import matplotlib.pyplot as plt
-import copy
 
 from ..data.io import load_labels_from_mat, load_data_from_path
-from ..generic import ProgressNotifier, DataStream
+from ..generic import ProgressNotifier, DataStream, show_or_save
 
 class Trainer():
     """ 
@@ -17,13 +16,15 @@ class Trainer():
     itself, as to enable easy obtaining of single datapoints with trainer.next()
     """
 
-    def __init__(self, datapath, labelpath, validation_split=0.2):
-        """ Initialize the trainer with path to data stored on device """
+    def __init__(self, datapath, labelpath, validation_split=0.2, cache_dir=None):
+        """ Initialize the trainer with path to data stored on device. If
+        `cache_dir` is given, the prepared data are cached there. """
 
         # Get the data and labels
         # valdata and vallabels are None if validation_split == 0.0
         traindata, trainlabels, valdata, vallabels = \
-            load_data_from_path(datapath, labelpath, validation_split=validation_split)
+            load_data_from_path(datapath, labelpath, 
+                validation_split=validation_split, cache_dir=cache_dir)
 
         self.datashape = traindata.shape[1], traindata.shape[2]
 
@@ -44,8 +45,10 @@ class Trainer():
         # due to criterion communicated from the model
         self.stop_training = False
 
-    def fit(self, model, epochs):
-        """ Fit a model on the internal data """
+    def fit(self, model, epochs, batch_size=32, plot_dir=None):
+        """ Fit a model on the internal data, feeding it `batch_size` images
+        per call. If `plot_dir` is given, the plots made after training are
+        saved there instead of being shown. """
         
         if self.datashape != model.input_layer.input_shape:
             raise ValueError(
@@ -67,34 +70,45 @@ class Trainer():
         self.stop_training = False
 
         # Collect the membrane potentials of the pooling layer for all images
-        # in all epochs
+        # in all epochs. They are stored flattened, so they can be passed to
+        # the classifier without reshaping, and as float32, since they are
+        # small spike counts that need no double precision
+        n_features = model.pooling_layer.output_shape[0] \
+            * model.pooling_layer.output_shape[1]
         train_potentials = np.empty((
             epochs, 
             self.trainstream.size, 
-            model.pooling_layer.output_shape[0], 
-            model.pooling_layer.output_shape[1]))
-        train_scores = []
+            n_features), dtype=np.float32)
+        # One score per epoch, trimmed at the end if training stops early
+        train_scores = np.empty(epochs)
         if self.uses_validation:
             val_potentials = np.empty((
                 epochs, 
                 self.valstream.size, 
-                model.pooling_layer.output_shape[0], 
-                model.pooling_layer.output_shape[1]))
-            val_scores = []
+                n_features), dtype=np.float32)
+            val_scores = np.empty(epochs)
         else:
             val_scores = None
             val_potentials = None
 
+        # Number of threads used for computing validation potentials
+        n_jobs = cpu_count()
+
         # Keep track of feature map activations to visualize it
         feature_map_activations = []
+        max_activation = 0.0
         if epochs <= 1:
             visualize_freq = 150
         else:
             visualize_freq = 2000
 
+        # Number of epochs actually run, in case training stops early
+        n_epochs_run = 0
+
         # Iterate through all epochs
         for epoch in range(epochs):
             print("\nEpoch {}/{}".format(epoch+1, epochs))
+            n_epochs_run = epoch + 1
             start_time = time.time()
 
             # Reset the trainer at the start of each epoch (i.e. index = 0)
@@ -102,30 +116,40 @@ class Trainer():
             self.trainstream.reset()
             self.train_prog.reset()
 
-            # TRAIN on the training data
-            for i in range(self.trainstream.size):
-                train_potentials[epoch,i] = model(self.trainstream.next())
-                self.train_prog.update()
-
-                # Stop training with criterion from model
+            # TRAIN on the training data, one batch at a time
+            for start in range(0, self.trainstream.size, batch_size):
+                batch = self.trainstream.next_batch(batch_size)
+                end = start + batch.shape[0]
+                step = epoch * self.trainstream.size + start
+
+                def save_snapshot(i):
+                    # Save weights for feature map visualisation right after
+                    # the visualisation step. Fancy indexing gathers a copy
+                    # of all three maps at once
+                    nonlocal max_activation
+                    if (step + i) % visualize_freq == 0:
+                        snapshot = model.conv_layer.weights[4, [4, 9, 14], :, :]
+                        feature_map_activations.append(snapshot)
+                        max_activation = max(max_activation, snapshot.max())
+
+                train_potentials[epoch,start:end] = model.batch(
+                    batch, on_sample=save_snapshot).reshape(
+                        batch.shape[0], n_features)
+                self.train_prog.update(batch.shape[0])
+
+                # Stop training with criterion from model, which is met if
+                # it was met for any sample in the batch
                 if model.check_stopping_criterion():
                     self.stop_training = True
-
-                if (epoch * self.trainstream.size + i) % visualize_freq == 0:
-                    # Save weights for feature map visualisation
-                    feature_map_activations.append([copy.copy(model.conv_layer.weights[4,  4, :, :]),
-                                                    copy.copy(model.conv_layer.weights[4,  9, :, :]),
-                                                    copy.copy(model.conv_layer.weights[4, 14, :, :])])
             print()
 
-            clf = svm.LinearSVC(max_iter=5000)
-            clf = clf.fit(
-                train_potentials[epoch].reshape(self.trainstream.size,9*50), 
-                self.trainstream.labels)
+            # Solve the primal problem, which is faster than the dual when
+            # there are more samples than features
+            clf = svm.LinearSVC(dual=False, max_iter=5000)
+            clf = clf.fit(train_potentials[epoch], self.trainstream.labels)
             train_score = clf.score(
-                train_potentials[epoch].reshape(self.trainstream.size,9*50), 
-                self.trainstream.labels)
-            train_scores.append(train_score)
+                train_potentials[epoch], self.trainstream.labels)
+            train_scores[epoch] = train_score
             print('Training Accuracy: {:.2f}'
                 .format(train_score))
 
@@ -136,16 +160,31 @@ class Trainer():
                 self.val_prog.reset()
 
                 model.freeze()
-                for i in range(self.valstream.size):
-                    val_potentials[epoch,i] = model(self.valstream.next())
-                    self.val_prog.update()
+                # Weights are frozen, so batches can be run in parallel. The
+                # frozen model does not change any internal state on a batch,
+                # so all threads can share it
+                with Parallel(n_jobs=n_jobs, prefer='threads') as parallel:
+                    start = 0
+                    while start < self.valstream.size:
+                        batches = []
+                        while len(batches) < n_jobs and \
+                                self.valstream.index < self.valstream.size:
+                            batches.append(self.valstream.next_batch(batch_size))
+                        results = parallel(
+                            delayed(model.batch)(batch) for batch in batches)
+                        for result in results:
+                            end = start + result.shape[0]
+                            val_potentials[epoch,start:end] = \
+                                result.reshape(result.shape[0], n_features)
+                            self.val_prog.update(result.shape[0])
+                            start = end
                 model.unfreeze()
                 print()
 
                 val_score = clf.score(
-                    val_potentials[epoch].reshape(self.valstream.size,9*50), 
+                    val_potentials[epoch], 
                     self.valstream.labels)
-                val_scores.append(val_score)
+                val_scores[epoch] = val_score
                 print('Validation Accuracy: {:.2f}'
                     .format(val_score))
 
@@ -165,26 +204,34 @@ class Trainer():
 
         print('\nFinished training\n')
 
-        self.plot_history(train_scores, val_scores, len(train_scores))
+        # Only keep scores of the epochs that were actually run
+        train_scores = train_scores[:n_epochs_run]
+        if self.uses_validation:
+            val_scores = val_scores[:n_epochs_run]
+
+        self.plot_history(train_scores, val_scores, len(train_scores),
+                          plot_dir=plot_dir)
         # Plot some feature maps at different times in training
         if feature_map_activations: # check if not empty
-            self.visualize_featuremaps(feature_map_activations, visualize_freq)
+            self.visualize_featuremaps(feature_map_activations, visualize_freq,
+                                       max_weight=max_activation,
+                                       plot_dir=plot_dir)
         # Plot all feature maps after training
-        self.plot_weights(model.conv_layer.weights)
+        self.plot_weights(model.conv_layer.weights, plot_dir=plot_dir)
         # Plot output of SNN for a sample of each digit
-        self.visualize_snn(model)
+        self.visualize_snn(model, plot_dir=plot_dir)
         
         return model, \
                train_potentials, val_potentials, \
                train_scores, val_scores, \
                feature_map_activations, visualize_freq
 
-    def plot_history(self, train_scores, val_scores, n_epochs):
+    def plot_history(self, train_scores, val_scores, n_epochs, plot_dir=None):
         fontsize=15
         
-        plt.figure(figsize=(20,10))
+        fig = plt.figure(figsize=(20,10))
         plt.plot(range(1, n_epochs+1), train_scores)
-        if val_scores:
+        if val_scores is not None:
             plt.plot(range(1, n_epochs+1), val_scores)
         plt.grid(True)
         plt.xlabel('Epoch', fontsize=fontsize)
@@ -192,9 +239,9 @@ class Trainer():
         plt.xticks(range(1, n_epochs+1), fontsize=fontsize*0.9)
         plt.yticks(fontsize=fontsize*0.9)
         plt.title('Training History', fontsize=fontsize*1.2)
-        plt.show()        
+        show_or_save(fig, plot_dir, 'train_history.png')
 
-    def visualize_snn(self, model):
+    def visualize_snn(self, model, plot_dir=None):
         """ Plot the output of the SNN (pooling potentials) for a sample of each digit """
         # Variables to keep track of plotted labels
         labels_used = []
@@ -236,10 +283,13 @@ class Trainer():
 
         # Show final plot
         plt.subplots_adjust(left=0.05, right=0.95, top=0.95)#, bottom=0.10, hspace=0.0, wspace=0.25)
-        plt.show()
+        show_or_save(fig, plot_dir, 'snn_outputs.png')
 
-    def visualize_featuremaps(self, activations, steps):
-        """ Plot the feature maps of the SNN (weight of CNN) for three feature maps """
+    def visualize_featuremaps(self, activations, steps, max_weight=None,
+                              plot_dir=None):
+        """ Plot the feature maps of the SNN (weight of CNN) for three feature
+        maps. `max_weight` is the largest weight in `activations`, and is
+        computed from them if not provided. """
         try:
             # Create subplots with general information
             fig, axs = plt.subplots(len(activations), 3)
@@ -250,7 +300,9 @@ class Trainer():
             fig.text(0.05, 0.5, 'Number of training samples', ha='center', va='center', rotation='vertical')
 
             min_weight = 0
-            max_weight = max(1, np.max(np.array(activations)))
+            if max_weight is None:
+                max_weight = max(np.max(item) for item in activations)
+            max_weight = max(1, max_weight)
             for index, item in enumerate(activations):
                 # Set label
                 axs[index, 0].set_ylabel(steps * index, rotation='horizontal', labelpad=17)
@@ -260,11 +312,11 @@ class Trainer():
                 axs[index, 2].imshow(item[2], vmin=min_weight, vmax=max_weight)
             plt.subplots_adjust(left=0.15, right=0.95, top=0.93, bottom=0.10, hspace=0.0, wspace=0.25)
             # Show final plot
-            plt.show()
+            show_or_save(fig, plot_dir, 'featuremaps.png')
         except:
             print("[!] Something went wrong with the feature map plot")
 
-    def plot_weights(self, activations):
+    def plot_weights(self, activations, plot_dir=None):
         """ Plot the feature maps of the SNN (weight of CNN) for all feature maps """
         # Create subplots with general information
         # fig, axs = plt.subplots(activations.shape[0]*2, int(activations.shape[1]/2))
@@ -330,4 +382,4 @@ class Trainer():
         fig.text(0.05, 0.5, 'Sharing window', ha='center', va='center', rotation='vertical')
         fig.text(0.5, 0.05, 'Feature map', ha='center', va='center', rotation='horizontal')
         plt.subplots_adjust(left=0.09, right=0.95, top=0.95, bottom=0.08, hspace=0.0, wspace=0.15)
-        plt.show()
\ No newline at end of file
+        show_or_save(fig, plot_dir, 'weights.png')
\ No newline at end of file